@@ -1,96 +1,431 @@
+import asyncio
+import functools
+import math
 import os
+import shutil
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from azure.cognitiveservices.speech import SpeechConfig, AudioConfig, SpeechRecognizer
-from azure.cognitiveservices.speech.audio import PullAudioInputStreamCallback
+from azure.cognitiveservices.speech import SpeechConfig, AudioConfig, SpeechRecognizer, ResultReason, CancellationReason, PropertyId, OutputFormat
+from azure.cognitiveservices.speech.audio import PullAudioInputStreamCallback, PullAudioInputStream, AudioStreamFormat, AudioStreamContainerFormat
 import yt_dlp
+from yt_dlp.postprocessor import FFmpegExtractAudioPP
 import tempfile
-from moviepy import AudioFileClip
 
-# Load environment variables from .env
-load_dotenv()
+# yt-dlp network settings: fetch DASH/HLS fragments in parallel and retry transient failures
+CONCURRENT_FRAGMENT_DOWNLOADS = 8
+DOWNLOAD_RETRIES = 3
+# YouTube's bestaudio formats are single files, which are fetched in 10 MiB range requests to avoid throttling
+HTTP_CHUNK_SIZE = 10485760
 
-# Azure Speech Service Configuration
-AZURE_SPEECH_KEY = os.getenv("AZURE_SPEECH_KEY")
-AZURE_REGION = os.getenv("AZURE_REGION")
+# Raw PCM layout produced by the streaming ffmpeg pipeline and fed to Azure
+STREAM_SAMPLE_RATE = 16000
+STREAM_BITS_PER_SAMPLE = 16
+STREAM_CHANNELS = 1
 
-if not AZURE_SPEECH_KEY or not AZURE_REGION:
-    raise ValueError("Azure Speech key or region is not set in the .env file.")
+# Silence (in ms) after which Azure closes a phrase; a longer timeout avoids cutting speech over music or pauses
+SEGMENTATION_SILENCE_TIMEOUT_MS = "2000"
+
+# Chunk layout for transcribe_audio_chunked; chunks overlap so words cut at a boundary appear whole in one of them
+CHUNK_SECONDS = 25
+CHUNK_OVERLAP_SECONDS = 2
+# Upper bound on concurrent ffmpeg processes and Azure requests, to stay within the resource's concurrency quota
+CHUNK_MAX_CONCURRENCY = 8
+
+# Compressed containers the Speech SDK decodes itself (through GStreamer), keyed by file extension
+COMPRESSED_CONTAINER_FORMATS = {
+    'mp3': AudioStreamContainerFormat.MP3,
+    # .ogg is usually Vorbis, which the OGG_OPUS decoder rejects, so let GStreamer detect the codec
+    'ogg': AudioStreamContainerFormat.ANY,
+    'opus': AudioStreamContainerFormat.OGG_OPUS,
+    'flac': AudioStreamContainerFormat.FLAC,
+    'm4a': AudioStreamContainerFormat.ANY,
+    'webm': AudioStreamContainerFormat.ANY,
+}
+
+@functools.lru_cache(maxsize=1)
+def _azure_creds() -> tuple[str, str]:
+    """Returns the Azure Speech Service key and region from the environment."""
+    # Load environment variables from .env; variables already set in the environment take precedence
+    load_dotenv()
+    azure_speech_key = os.getenv("AZURE_SPEECH_KEY")
+    azure_region = os.getenv("AZURE_REGION")
+
+    if not azure_speech_key or not azure_region:
+        raise ValueError("Azure Speech key or region is not set in the .env file.")
+    return azure_speech_key, azure_region
+
+@functools.lru_cache(maxsize=1)
+def _speech_config() -> SpeechConfig:
+    """Returns the Azure Speech configuration shared by all recognizers."""
+    azure_speech_key, azure_region = _azure_creds()
+    speech_config = SpeechConfig(subscription=azure_speech_key, region=azure_region)
+    speech_config.output_format = OutputFormat.Detailed
+    speech_config.set_property(PropertyId.Speech_SegmentationSilenceTimeoutMs, SEGMENTATION_SILENCE_TIMEOUT_MS)
+    return speech_config
+
+class _ReaderStreamCallback(PullAudioInputStreamCallback):
+    """Lets Azure pull audio bytes on demand from a binary reader such as a pipe."""
+
+    def __init__(self, reader):
+        super().__init__()
+        self._reader = reader
+
+    def read(self, buffer: memoryview) -> int:
+        # Returning 0 signals the end of the stream to the SDK
+        return self._reader.readinto(buffer) or 0
+
+    def close(self) -> None:
+        self._reader.close()
 
 def download_audio_from_url(url: str) -> str:
-    """Downloads audio from a YouTube URL and converts it to WAV format using yt-dlp."""
+    """Downloads audio from a YouTube URL using yt-dlp, converting it to WAV only if Azure cannot decode it."""
     try:
-        # Define yt-dlp options
         with tempfile.TemporaryDirectory() as temp_dir:
             # Define yt-dlp options with a proper outtmpl template
             ydl_opts = {
                 'format': 'bestaudio/best',
                 'outtmpl': os.path.join(temp_dir, '%(title)s.%(ext)s'),  # Template for output filename
                 'quiet': True,  # Suppress yt-dlp output
+                'concurrent_fragment_downloads': CONCURRENT_FRAGMENT_DOWNLOADS,
+                'http_chunk_size': HTTP_CHUNK_SIZE,
+                'retries': DOWNLOAD_RETRIES,
+                'fragment_retries': DOWNLOAD_RETRIES,
+                # Arguments for the extract-audio postprocessor, producing the 16 kHz mono WAV expected by Azure
+                'postprocessor_args': {
+                    'extractaudio': ['-ac', '1', '-ar', '16000', '-acodec', 'pcm_s16le'],
+                },
             }
 
-        print(f"Downloading audio from: {url}")
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(url, download=True)
-            downloaded_file = ydl.prepare_filename(info_dict)
-
-        # Create a temporary file for the WAV output
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_wav_file:
-            wav_path = temp_wav_file.name
+            print(f"Downloading audio from: {url}")
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                # Resolve the format first so we know whether the container needs transcoding
+                info_dict = ydl.extract_info(url, download=False)
+                if info_dict['ext'] not in COMPRESSED_CONTAINER_FORMATS:
+                    ydl.add_post_processor(FFmpegExtractAudioPP(ydl, preferredcodec='wav', preferredquality='0'))
+                info_dict = ydl.process_ie_result(info_dict, download=True)
+                downloaded_file = ydl.prepare_filename(info_dict)
 
-        # Convert downloaded audio to WAV using moviepy
-        print("Converting audio to WAV format...")
-        audio_clip = AudioFileClip(downloaded_file)
-        audio_clip.write_audiofile(wav_path, codec='pcm_s16le')
-        audio_clip.close()
+            if info_dict['ext'] in COMPRESSED_CONTAINER_FORMATS:
+                audio_ext = info_dict['ext']
+            else:
+                # The extract-audio postprocessor replaces the original download with a .wav file
+                audio_ext = 'wav'
+                downloaded_file = os.path.splitext(downloaded_file)[0] + '.wav'
 
+            # Move the audio out of temp_dir so it survives the directory cleanup
+            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{audio_ext}") as temp_audio_file:
+                audio_path = temp_audio_file.name
+            shutil.move(downloaded_file, audio_path)
 
-        # Clean up the intermediate .webm file
-        os.remove(downloaded_file)
-        
-        # TODO: do we need to delete the wav file at a later stage?
-        return wav_path
+        # TODO: do we need to delete the audio file at a later stage?
+        return audio_path
     except Exception as e:
         raise RuntimeError(f"Failed to download or convert audio: {str(e)}")
 
+def _audio_config_for_file(audio_path: str) -> AudioConfig:
+    """Builds an AudioConfig for a WAV file, or a compressed stream for containers Azure decodes itself."""
+    audio_ext = os.path.splitext(audio_path)[1].lstrip('.').lower()
+    container_format = COMPRESSED_CONTAINER_FORMATS.get(audio_ext)
+    if container_format is None:
+        return AudioConfig(filename=audio_path)
+
+    audio_file = open(audio_path, 'rb')
+    try:
+        pull_stream = PullAudioInputStream(
+            pull_stream_callback=_ReaderStreamCallback(audio_file),
+            stream_format=AudioStreamFormat(compressed_stream_format=container_format),
+        )
+        return AudioConfig(stream=pull_stream)
+    except Exception:
+        # The SDK only closes the file through the callback once the stream is in use
+        audio_file.close()
+        raise
+
+def _release_recognizer(speech_recognizer: SpeechRecognizer, started: bool = False) -> None:
+    """Stops continuous recognition if it was started and drops the event handlers.
+
+    Releasing explicitly frees the SDK's websocket and audio handles right away, rather than whenever the
+    recognizer happens to be garbage collected.
+    """
+    try:
+        if started:
+            speech_recognizer.stop_continuous_recognition_async().get()
+    finally:
+        speech_recognizer.recognized.disconnect_all()
+        speech_recognizer.session_stopped.disconnect_all()
+        speech_recognizer.canceled.disconnect_all()
+
 def transcribe_audio(audio_path: str) -> str:
     """Transcribes audio to text using Azure Speech Service."""
-    speech_config = SpeechConfig(subscription=AZURE_SPEECH_KEY, region=AZURE_REGION)
-    audio_config = AudioConfig(filename=audio_path)
-    speech_recognizer = SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+    audio_config = _audio_config_for_file(audio_path)
+    speech_recognizer = SpeechRecognizer(speech_config=_speech_config(), audio_config=audio_config)
+
+    done = threading.Event()
+    parts = []
+    cancellations = []
+
+    def on_recognized(evt):
+        if evt.result.reason == ResultReason.RecognizedSpeech:
+            parts.append(evt.result.text)
+
+    def on_canceled(evt):
+        if evt.cancellation_details.reason == CancellationReason.Error:
+            cancellations.append(evt.cancellation_details)
+        done.set()
+
+    speech_recognizer.recognized.connect(on_recognized)
+    speech_recognizer.session_stopped.connect(lambda evt: done.set())
+    speech_recognizer.canceled.connect(on_canceled)
 
     audio_file_name = os.path.basename(audio_path)
     print(f"Starting transcription of file {audio_file_name}")
-    # TODO: replace by .start_continuous_recognition_async for audio files > 30s
-    result = speech_recognizer.recognize_once()
+    # Continuous recognition keeps going past the ~15 s limit of recognize_once
+    started = False
+    try:
+        speech_recognizer.start_continuous_recognition_async().get()
+        started = True
+        done.wait()
+    finally:
+        _release_recognizer(speech_recognizer, started)
+        del speech_recognizer, audio_config
+
+    # A canceled session stops early, so the phrases collected so far are an incomplete transcript
+    if cancellations:
+        print(f"Speech recognition failed. Reason: {cancellations[0].error_details}")
+        return ""
+
+    if not parts:
+        print("No speech could be recognized.")
+        return ""
+
+    print("Transcription successful!")
+    return " ".join(parts)
+
+async def _probe_duration(audio_path: str) -> float:
+    """Returns the duration of an audio file in seconds using ffprobe."""
+    proc = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", audio_path,
+        stdout=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffprobe failed for {audio_path} (exit code {proc.returncode})")
+    return float(stdout)
+
+async def _extract_chunk(audio_path: str, chunk_path: str, start: float, duration: float) -> None:
+    """Cuts a 16 kHz mono WAV chunk out of an audio file using ffmpeg."""
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+        "-ss", str(start), "-t", str(duration), "-i", audio_path,
+        "-ac", "1", "-ar", "16000", "-acodec", "pcm_s16le",
+        chunk_path,
+    )
+    if await proc.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed to extract chunk at {start}s (exit code {proc.returncode})")
 
-    if result.reason == result.Reason.RecognizedSpeech:
-        print("Transcription successful!")
+async def _recognize_chunk(chunk_path: str) -> str:
+    """Runs a single recognize_once request on a chunk file."""
+    audio_config = AudioConfig(filename=chunk_path)
+    speech_recognizer = SpeechRecognizer(speech_config=_speech_config(), audio_config=audio_config)
+    try:
+        result = await asyncio.to_thread(speech_recognizer.recognize_once_async().get)
+    finally:
+        # Dropping the last references closes the chunk file and connection before the chunk is removed
+        del speech_recognizer, audio_config
+
+    if result.reason == ResultReason.RecognizedSpeech:
         return result.text
-    elif result.reason == result.Reason.NoMatch:
+    if result.reason == ResultReason.NoMatch:
+        return ""
+
+    chunk_file_name = os.path.basename(chunk_path)
+    if result.reason == ResultReason.Canceled:
+        cancellation_details = result.cancellation_details
+        # Reaching the end of a silent chunk is not an error, anything else (throttling, auth, ...) is
+        if cancellation_details.reason == CancellationReason.EndOfStream:
+            return ""
+        raise RuntimeError(
+            f"Speech recognition of {chunk_file_name} was canceled. "
+            f"Reason: {cancellation_details.reason}, {cancellation_details.error_details}"
+        )
+    raise RuntimeError(f"Speech recognition of {chunk_file_name} failed. Reason: {result.reason}")
+
+async def transcribe_audio_chunked(
+    audio_path: str,
+    chunk_seconds: float = CHUNK_SECONDS,
+    overlap_seconds: float = CHUNK_OVERLAP_SECONDS,
+    max_concurrency: int = CHUNK_MAX_CONCURRENCY,
+) -> str:
+    """Transcribes audio by sending overlapping chunks to Azure Speech Service concurrently.
+
+    The result is lossy: recognize_once keeps only the first phrase of each chunk, so speech after the
+    first pause in a chunk is dropped, and words inside the overlap may appear twice. Use transcribe_audio
+    for a complete transcript.
+    """
+    if not 0 <= overlap_seconds < chunk_seconds:
+        raise ValueError(
+            f"overlap_seconds must be at least 0 and less than chunk_seconds "
+            f"(got overlap_seconds={overlap_seconds}, chunk_seconds={chunk_seconds})"
+        )
+
+    duration = await _probe_duration(audio_path)
+    step = chunk_seconds - overlap_seconds
+    chunk_count = max(1, math.ceil((duration - overlap_seconds) / step))
+    starts = [i * step for i in range(chunk_count)]
+
+    audio_file_name = os.path.basename(audio_path)
+    print(f"Starting chunked transcription of file {audio_file_name} ({chunk_count} chunks)")
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def transcribe_chunk(chunk_path: str, start: float) -> str:
+        # Each chunk is recognized as soon as it is cut, and at most max_concurrency chunk files exist at once
+        async with semaphore:
+            await _extract_chunk(audio_path, chunk_path, start, chunk_seconds)
+            try:
+                return await _recognize_chunk(chunk_path)
+            finally:
+                os.remove(chunk_path)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Azure serves concurrent requests per resource, so chunks are recognized in parallel up to max_concurrency
+        texts = await asyncio.gather(*[
+            transcribe_chunk(os.path.join(temp_dir, f"chunk_{i}.wav"), start)
+            for i, start in enumerate(starts)
+        ])
+
+    transcription = " ".join(text for text in texts if text)
+    if not transcription:
         print("No speech could be recognized.")
         return ""
-    else:
-        print(f"Speech recognition failed. Reason: {result.reason}")
+
+    print("Transcription successful!")
+    return transcription
+
+def _spawn_audio_pipeline(url: str) -> tuple[subprocess.Popen, subprocess.Popen]:
+    """Spawns yt-dlp piped into ffmpeg, which emits raw 16 kHz mono PCM on its stdout."""
+    ydl_proc = subprocess.Popen(
+        [
+            # Run the installed yt_dlp package rather than relying on the console script being on PATH
+            sys.executable, "-m", "yt_dlp", "--quiet",
+            "--format", "bestaudio/best",
+            "--concurrent-fragments", str(CONCURRENT_FRAGMENT_DOWNLOADS),
+            "--http-chunk-size", str(HTTP_CHUNK_SIZE),
+            "--retries", str(DOWNLOAD_RETRIES),
+            "--fragment-retries", str(DOWNLOAD_RETRIES),
+            "--output", "-",
+            url,
+        ],
+        stdout=subprocess.PIPE,
+    )
+    ffmpeg_proc = subprocess.Popen(
+        [
+            "ffmpeg", "-loglevel", "error",
+            "-i", "pipe:0",
+            "-f", "s16le", "-ac", str(STREAM_CHANNELS), "-ar", str(STREAM_SAMPLE_RATE),
+            "pipe:1",
+        ],
+        stdin=ydl_proc.stdout,
+        stdout=subprocess.PIPE,
+    )
+    # Only ffmpeg reads yt-dlp's output; closing our copy lets yt-dlp see a broken pipe if ffmpeg dies
+    ydl_proc.stdout.close()
+    return ydl_proc, ffmpeg_proc
+
+async def transcribe_audio_from_url(url: str) -> str:
+    """Transcribes audio from a URL while it is still downloading, using Azure Speech Service."""
+    loop = asyncio.get_running_loop()
+    done = asyncio.Event()
+    parts = []
+    cancellations = []
+
+    stream_format = AudioStreamFormat(
+        samples_per_second=STREAM_SAMPLE_RATE,
+        bits_per_sample=STREAM_BITS_PER_SAMPLE,
+        channels=STREAM_CHANNELS,
+    )
+
+    def on_recognized(evt):
+        if evt.result.reason == ResultReason.RecognizedSpeech:
+            parts.append(evt.result.text)
+
+    def on_canceled(evt):
+        if evt.cancellation_details.reason == CancellationReason.Error:
+            cancellations.append(evt.cancellation_details)
+        loop.call_soon_threadsafe(done.set)
+
+    # Resolve credentials before starting a download that would be thrown away if they are missing
+    speech_config = _speech_config()
+
+    print(f"Streaming audio from: {url}")
+    ydl_proc, ffmpeg_proc = _spawn_audio_pipeline(url)
+    try:
+        # Azure reads ffmpeg's stdout directly, so the audio never lands on disk
+        pull_stream = PullAudioInputStream(
+            pull_stream_callback=_ReaderStreamCallback(ffmpeg_proc.stdout),
+            stream_format=stream_format,
+        )
+        audio_config = AudioConfig(stream=pull_stream)
+        speech_recognizer = SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+        started = False
+        try:
+            # SDK callbacks run on native threads, so the event must be set through the loop
+            speech_recognizer.recognized.connect(on_recognized)
+            speech_recognizer.session_stopped.connect(lambda evt: loop.call_soon_threadsafe(done.set))
+            speech_recognizer.canceled.connect(on_canceled)
+
+            await asyncio.to_thread(lambda: speech_recognizer.start_continuous_recognition_async().get())
+            started = True
+            await done.wait()
+        finally:
+            # Release the recognizer before waiting on the pipeline processes
+            await asyncio.to_thread(_release_recognizer, speech_recognizer, started)
+            del speech_recognizer, audio_config, pull_stream
+    finally:
+        ffmpeg_proc.stdout.close()
+        # Wait off the event loop so concurrent transcriptions are not serialized on process exit
+        await asyncio.to_thread(ffmpeg_proc.wait)
+        await asyncio.to_thread(ydl_proc.wait)
+
+    # An Azure error closes the pipe early and kills the pipeline, so report it before the exit codes
+    if cancellations:
+        raise RuntimeError(f"Speech recognition failed. Reason: {cancellations[0].error_details}")
+
+    if ydl_proc.returncode != 0 or ffmpeg_proc.returncode != 0:
+        raise RuntimeError(
+            f"Audio pipeline failed (yt-dlp exit code {ydl_proc.returncode}, "
+            f"ffmpeg exit code {ffmpeg_proc.returncode})"
+        )
+
+    if not parts:
+        print("No speech could be recognized.")
         return ""
 
+    print("Transcription successful!")
+    return " ".join(parts)
+
 # Main function
 def process_audio_from_url(url: str) -> str:
     """Processes audio from a URL and returns the transcription."""
     try:
-        # Download and prepare audio
-        audio_path = download_audio_from_url(url)
-        
-        # Transcribe the audio
-        transcription = transcribe_audio(audio_path)
-        
-        # Clean up temporary audio file
-        os.remove(audio_path)
-        
-        return transcription
+        # Download and transcribe concurrently, so Azure starts before the download ends
+        return asyncio.run(transcribe_audio_from_url(url))
     except Exception as e:
         print(f"Error processing audio: {str(e)}")
         return ""
 
+def process_urls(urls: list[str], max_workers: int = 8) -> dict[str, str]:
+    """Processes several URLs concurrently and returns their transcriptions keyed by URL."""
+    # Download and recognition are network-bound, so threads scale with bandwidth and Azure quota
+    transcriptions = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_audio_from_url, url): url for url in urls}
+        for future in as_completed(futures):
+            transcriptions[futures[future]] = future.result()
+    return transcriptions
+
 # Example Usage
 if __name__ == "__main__":
     # Replace this with the actual URL of a YouTube video or other audio source